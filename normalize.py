@@ -1,52 +1,69 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 # Insert pages into exams, given the correct exam length and
 # a special marker on the cover page of each exam.
 
-import os
 import sys
+import shutil
 import argparse
-import tempfile
-from wand.image import Image
-from qrtools import QR
-from multiprocessing import Pool
-
-# hack to get pypdftk to import correctly on mac
-if not os.path.exists('/usr/bin/pdftk'):
-    os.environ['PDFTK_PATH'] = '/usr/local/bin/pdftk'
-import pypdftk
+import fitz
+from pyzbar.pyzbar import decode as decode_qr
+from multiprocessing import Pool, cpu_count
 
 FRONT_PAGE_CODE = "exam-normalizer-1"
 HEAP_PAGE_CODE = "exam-normalizer-2"
 BLANK_PAGE_FILENAME = "blank.pdf"
 
-class Document(object):
+# Pages whose low-resolution grayscale render has a pixel standard deviation
+# below this are treated as blank scans and skipped without a QR decode.
+BLANK_PAGE_STD_THRESHOLD = 4.0
+
+# First-pass render resolution for QR detection, plenty for a clean scan,
+# and the resolution for the retry pass on pages scanned while a cover is
+# overdue (see split_documents).
+QR_DPI = 90
+QR_RETRY_DPI = 200
+
+# The parsed blank page, opened once on first use and reused for every
+# padding page thereafter.
+_blank_doc = None
+
+def get_blank_doc():
+    """Return the blank padding page as a parsed document, opening and
+    parsing blank.pdf only once no matter how many times it is used."""
+    global _blank_doc
+    if _blank_doc is None:
+        _blank_doc = fitz.open(BLANK_PAGE_FILENAME)
+    return _blank_doc
+
+class Document:
     """Class representing a document. Automatically handles padding to the
     correct length."""
     def __init__(self, target_length):
         self._scans = []
+        self._pages = None
         self.target_length = target_length
         self.has_heap_page = False
 
     def add_page(self, page):
-        """Page should be a tuple of (pdf filename, image filename)."""
+        """Page should be the page's number in the source document."""
         self._scans.append(page)
+        self._pages = None
 
     @property
     def pages(self):
         """Returns the list of pages added to this document so far, with
-        padding to a multiple of the target length."""
-        padding = [(BLANK_PAGE_FILENAME, None)]
-        if self.isPadded and not self.has_heap_page:
-            pages = self._scans[:12] + 2*padding + self._scans[12:]
-        else:
-            pages = self._scans
-        return pages + padding*(-len(pages) % self.target_length)
-
-    @property
-    def pdf_pages(self):
-        """As pages, but returns only the pdfs, not associated images."""
-        return [pdf for pdf, _ in self.pages]
+        padding to a multiple of the target length. Padding pages are
+        represented by None. The list is computed once and cached until
+        another page is added."""
+        if self._pages is None:
+            padding = [None]
+            if self.isPadded and not self.has_heap_page:
+                pages = self._scans[:12] + 2*padding + self._scans[12:]
+            else:
+                pages = list(self._scans)
+            self._pages = pages + padding*(-len(pages) % self.target_length)
+        return self._pages
 
     @property
     def length(self):
@@ -61,89 +78,114 @@ class Document(object):
         return self.padding_length > 0
 
 
-def split(input_filename):
-    """Split the input file given by input_filename into individual pages.
-    The page files will be written as PDFs into a temporary directory.
-    Returns a tuple, where the first element is the output directory name,
-    and the second is the list of PDFs of the pages."""
-    pdf_directory = tempfile.mkdtemp(dir="./")
-    pages = pypdftk.split(input_filename, pdf_directory)
-    # Keep only PDFs. PDFTk puts out a document info text file as well, which
-    # we delete.
-    pdfs = []
-    for page in pages:
-        if page.rsplit(".", 1)[1] == "pdf":
-            pdfs.append(page)
-        else:
-            os.remove(page)
-    # sort pdfs into correct order (by extracting the actual page number)
-    pdfs.sort(key=lambda s: int(s[s.rfind('page_') + 5:-4]))
-    return (pdf_directory, pdfs)
-
-def convert_file_to_image(file_dir_tuple):
-    """Convert a single file into a jpg. Helper function to convert_to_images.
-    input_file and output_dir are received as a tuple so this can be more easily
-    used with Pool.map."""
-    input_file, image_directory = file_dir_tuple
-    handle, output_filename = tempfile.mkstemp(dir=image_directory,
-                                               suffix=".jpg")
-    with Image(filename=input_file, resolution=150) as img:
-        img.gaussian_blur(0, 1.)
-        img.compression_quality = 97
-        img.save(filename=output_filename)
-    os.close(handle)
-    return output_filename
-
-def convert_to_images(input_filenames):
-    """ Convert each of the files given by the input filenames into a jpg.
-    The files will be written into a temporary directory.
-    Return a tuple, where the first element is the directory created to hold
-    the images, and the second is a list of image filenames. """
-    pool = Pool(4)
-    image_directory = tempfile.mkdtemp(dir="./")
-    # pack arguments to convert_file_to_image
-    input_filenames = zip(input_filenames,
-                          [image_directory]*len(input_filenames))
-    image_files = pool.map(convert_file_to_image,
-                           input_filenames)
-    return (image_directory, image_files)
-
-def get_qr_code(image_filename):
-    """ Return True if the given image is a front page (based on a QR code)
-    or false otherwise. The QR code must contain FRONT_PAGE_CODE to indicate
-    that the page is a front page. """
-    scanner = QR(filename=image_filename)
-    if scanner.decode():
-        data = scanner.data
-        return data
-    else:
+# Per-worker handle on the source document, opened once per worker process by
+# init_worker instead of once per page.
+_worker_doc = None
+
+def init_worker(input_filename):
+    """Pool initializer: parse the source document once for this worker."""
+    global _worker_doc
+    _worker_doc = fitz.open(input_filename)
+
+def pixmap_std(pixmap):
+    """Return the standard deviation of the pixel values in the given
+    pixmap."""
+    samples = bytearray(pixmap.samples)
+    count = len(samples)
+    mean = sum(samples) / count
+    mean_square = sum(s*s for s in samples) / count
+    return (mean_square - mean*mean) ** 0.5
+
+def decode_page(page, dpi):
+    """Render the given page at the given resolution and decode the QR code
+    on it, if any. pyzbar decodes straight from the raw grayscale buffer, so
+    the render is never encoded to an image file or re-read from disk.
+    Returns the code, or None."""
+    pixmap = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+    results = decode_qr((pixmap.samples, pixmap.width, pixmap.height))
+    return results[0].data.decode("utf-8") if results else None
+
+def process_page(page_number):
+    """Rasterize one page of the source document and decode the QR code (if
+    any) on it in one pass, entirely in memory. Helper function to
+    process_pages.
+    Returns the decoded code, or None for pages without one; blank scans are
+    detected from a cheap thumbnail and skipped without the full render or
+    decode."""
+    page = _worker_doc[page_number]
+    # Cheap prefilter: a blank scan renders to a near-uniform thumbnail, and
+    # needs neither the full-resolution render nor a QR decode.
+    thumbnail = page.get_pixmap(dpi=18, colorspace=fitz.csGRAY)
+    if pixmap_std(thumbnail) < BLANK_PAGE_STD_THRESHOLD:
         return None
+    return decode_page(page, QR_DPI)
 
-def split_documents(pages, correct_length):
-    """Given a list of all the documents' pages in order, detects cover pages
-    and splits into Documents.
-    pages: a list of tuples, where each tuple is:
-           0. The page's PDF filename
-           1. The page's image filename
+def process_pages(pool, pages):
+    """Rasterize and QR-scan each of the given source page numbers on the
+    given worker pool.
+    Returns an iterator of the decoded codes (None where a page has none) in
+    page order, yielding each result as soon as that page has been scanned
+    so downstream work can overlap with the scanning."""
+    return pool.imap(process_page, pages, chunksize=4)
+
+def split_documents(source, pages, codes, correct_length):
+    """Given all the documents' pages in order, detects cover pages and
+    splits into Documents.
+    source: the open source document, used to re-render pages for retries.
+    pages: a list of the pages' numbers in the source document.
+    codes: an iterable of the pages' QR codes (None where a page has none),
+           in the same order. May be a lazy iterator; pages are consumed as
+           their codes arrive.
+    Pages scanned while a cover is overdue - the current document has
+    already reached the target length without a new cover turning up - get
+    one more decode at QR_RETRY_DPI, in case they are covers whose code
+    did not survive the first-pass resolution.
     Returns a list of Documents.
     """
     documents = []
     cur_doc = Document(correct_length)
-    for page_tuple in pages:
-        _, image_name = page_tuple
-        code = get_qr_code(image_name)
+    for page_number, code in zip(pages, codes):
+        if code is None and cur_doc.length >= correct_length:
+            code = decode_page(source[page_number], QR_RETRY_DPI)
         if code is not None:
-            print code
+            print(code)
         if code == FRONT_PAGE_CODE:
             if cur_doc.length > 0:
                 documents.append(cur_doc)
             cur_doc = Document(correct_length)
         elif code == HEAP_PAGE_CODE:
             cur_doc.has_heap_page = True
-        cur_doc.add_page(page_tuple)
+        cur_doc.add_page(page_number)
     documents.append(cur_doc)
     return documents
 
+def append_pages(output, source, page_numbers):
+    """Append the given pages of the source document to the output document,
+    in order. A page number of None stands for a padding page, spliced in
+    from the cached blank page document instead of being re-parsed from disk
+    for every occurrence.
+    Only the source, the blank page, and the output are ever open, so the
+    number of open file handles stays constant no matter how many pages are
+    appended."""
+    for page_number in page_numbers:
+        if page_number is None:
+            output.insert_pdf(get_blank_doc(), from_page=0, to_page=0)
+        else:
+            output.insert_pdf(source, from_page=page_number,
+                              to_page=page_number)
+
+def is_normalized(source, pool, correct_length):
+    """Return True if the source already consists of whole exams of the
+    correct length: the page count is a multiple of correct_length and every
+    correct_length-th page is a cover. Only the candidate cover pages are
+    scanned, so this assumes covers appear nowhere else; a batch that fails
+    the check simply takes the full pipeline."""
+    if source.page_count == 0 or source.page_count % correct_length != 0:
+        return False
+    covers = range(0, source.page_count, correct_length)
+    return all(code == FRONT_PAGE_CODE
+               for code in pool.imap(process_page, covers))
+
 def show_summary(good_docs, padded_docs):
     print("\n--- Summary ---\n")
     total_docs = len(good_docs) + len(padded_docs)
@@ -151,8 +193,8 @@ def show_summary(good_docs, padded_docs):
     print("Did not alter: {0} documents".format(len(good_docs)))
     print("Added padding: {0} documents".format(len(padded_docs)))
     padding_counts = [doc.padding_length for doc in padded_docs]
-    average_padding = float(sum(padding_counts)) / len(padding_counts) \
-                      if len(padding_counts) > 0 else float(0)
+    average_padding = sum(padding_counts) / len(padding_counts) \
+                      if padding_counts else 0.0
     print("Average padding: {0} pages".format(average_padding))
     long_docs = [doc for doc in good_docs if doc.length > doc.target_length]
     if len(long_docs) > 0:
@@ -162,29 +204,41 @@ def show_summary(good_docs, padded_docs):
               ))
 
 def main(input_filename, output_filename, correct_length):
-    pdf_directory, pages = split(input_filename)
-    image_directory, images = convert_to_images(pages)
-    pages_with_images = zip(pages, images)
-
-    docs = split_documents(pages_with_images, correct_length)
-    # split into docs with and without padding
-    good_docs = [doc for doc in docs if not doc.isPadded]
-    padded_docs = [doc for doc in docs if doc.isPadded]
-    # flatten and pull out just the pdf filenames
-    good_pdfs = [pdf for doc in good_docs for pdf in doc.pdf_pages]
-    padded_pdfs = [pdf for doc in padded_docs for pdf in doc.pdf_pages]
-
-    if len(good_pdfs) > 0:
-        pypdftk.concat(good_pdfs, output_filename + '_good.pdf')
-    if len(padded_pdfs) > 0:
-        pypdftk.concat(padded_pdfs, output_filename + '_padded.pdf')
-
-    # cleanup temp files
-    for pdf_name, image_name in pages_with_images:
-        os.remove(pdf_name)
-        os.remove(image_name)
-    os.rmdir(pdf_directory)
-    os.rmdir(image_directory)
+    source = fitz.open(input_filename)
+    pages = list(range(source.page_count))
+    with Pool(cpu_count(), init_worker, (input_filename,)) as pool:
+        # Fast path: a batch that is already whole exams of the correct
+        # length needs no splitting or padding, so the "good" output is just
+        # a copy of the input.
+        if is_normalized(source, pool, correct_length):
+            source.close()
+            shutil.copy(input_filename, output_filename + '_good.pdf')
+            print("Input is already normalized; "
+                  "copied to {0}_good.pdf".format(output_filename))
+            return 0
+        codes = process_pages(pool, pages)
+        docs = split_documents(source, pages, codes, correct_length)
+    # route each document's pages to the right output as we go, rather than
+    # flattening everything into page lists first
+    good_docs = []
+    padded_docs = []
+    good_output = fitz.open()
+    padded_output = fitz.open()
+    for doc in docs:
+        if doc.isPadded:
+            padded_docs.append(doc)
+            append_pages(padded_output, source, doc.pages)
+        else:
+            good_docs.append(doc)
+            append_pages(good_output, source, doc.pages)
+
+    if good_output.page_count > 0:
+        good_output.save(output_filename + '_good.pdf')
+    if padded_output.page_count > 0:
+        padded_output.save(output_filename + '_padded.pdf')
+    good_output.close()
+    padded_output.close()
+    source.close()
 
     show_summary(good_docs, padded_docs)
 